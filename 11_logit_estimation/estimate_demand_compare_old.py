@@ -8,12 +8,18 @@ import time
 import os
 import pickle
 import sys
+import gc
 import pathlib
+import hashlib
+import functools
+import inspect
 from scipy.optimize import minimize
 import platform
 from time import sleep
 
 from linearmodels.iv import IV2SLS # this is to check IV results
+from joblib import Parallel, delayed
+from threadpoolctl import threadpool_limits
 
 from Reference import functions_v2 as exp_functions
 import functions_rlp as rlp_functions 
@@ -36,6 +42,7 @@ incl_2021 = True
 rlp_market ='county_model_year'
 date_time = time.strftime("%m%d-%H%M")
 zms_replaced_with = 0.01
+run_by_model_year = False # Also run the comparison separately for each model year
 
 ############################################################################################################
 # Set up main paths and directories
@@ -57,6 +64,7 @@ str_mapping = str_rlp / "brand_to_oem_generated.csv"
 estimation_test = str_data / "estimation_data_test"
 str_rlp_new = str_rlp / "rlp_with_dollar_per_mile_replaced_myear_county_20240822_163435_no_lease_zms.csv" 
 str_pop_density = str_data / "other_data" / "population_by_year_counties.csv"
+prepared_data_cache = estimation_test / "prepared_data_cache"
 
 
 
@@ -103,12 +111,47 @@ Replace ZMS with: {zms_replaced_with}
 logging.info("\n"+ description_template + "\n----------------------------------------------------------")
 ############################################################################################################
 # Helper functions
+def cache_prepared_data(*input_paths):
+    """
+    Cache the DataFrame returned by a data preparation function as a pickle in prepared_data_cache.
+    The cache key covers the function arguments, the module-level settings, the function's source, and the
+    modification times of input_paths and of the code that builds the data - so the data is rebuilt whenever
+    any of them change. A missing input file raises, rather than producing a key.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = hashlib.blake2b(digest_size = 16)
+            key.update(repr((version, dynamic, incl_2021, rlp_market)).encode())
+            key.update(inspect.getsource(func).encode())
+            for arg in list(args) + sorted(kwargs.items()):
+                if isinstance(arg, pd.DataFrame):
+                    key.update(pd.util.hash_pandas_object(arg).values.tobytes())
+                else:
+                    key.update(repr(arg).encode())
+            code_paths = [__file__, rlp_functions.__file__, exp_functions.__file__]
+            for path in list(input_paths) + code_paths:
+                key.update(str(os.path.getmtime(path)).encode())
+            cache_path = prepared_data_cache / f"{func.__name__}_{key.hexdigest()}.pkl"
+
+            if cache_path.exists():
+                logging.info(f"Loading cached {func.__name__} output from {cache_path}")
+                return pd.read_pickle(cache_path)
+
+            output = func(*args, **kwargs)
+            prepared_data_cache.mkdir(exist_ok = True)
+            output.to_pickle(cache_path)
+            return output
+        return wrapper
+    return decorator
+
 def remove_makes(df, makes):
-    for make in makes:
-        df = df[df["make"]!=make]
-    return df
+    return df[~df["make"].isin(makes)]
 
 # We prepare the Experian data for estimation
+@cache_prepared_data(str_data / "intermediate" / "US_VIN_data_common.csv",
+                     str_data / "raw" / "census_pop_state.csv",
+                     str_data / "intermediate" / "haircut_market_size.csv")
 def prepare_experian_data(makes_to_remove = None):
     # read in VIN data - file of approx 100000 rows, including car characteristics
     exp_vin_data = exp_functions.read_vin_data(str_project,str_data,version,dynamic)
@@ -135,26 +178,35 @@ def prepare_experian_data(makes_to_remove = None):
     if makes_to_remove:
         exp_mkt_data = remove_makes(exp_mkt_data, makes_to_remove)
 
+    # Convert the OLS dummy columns to categoricals once, so get_dummies does not re-factorize the strings on
+    # every run_logit_model call. (PyBLP turns these back into object arrays, so this does not help the logit side)
+    for col in ['make', 'drivetype', 'bodytype']:
+        exp_mkt_data[col] = exp_mkt_data[col].astype("category")
+
     return exp_mkt_data
 
 # We now prepare the RLP data, aiming to make it as similar as possible to the Experian data
+@cache_prepared_data(str_mapping,
+                     str_data / "other_data" / ("hhs_by_year_counties.csv" if rlp_market == "county_model_year" else "hhs_by_year.csv"),
+                     str_pop_density)
 def prepare_rlp_data(df, pop_density_path, makes_to_remove = None, mkt_def = "model_year", year_to_drop = None, zms_replaced_with = 0.001):
-    # Drop relevant market years
-    df = df.loc[~((df["model_year"]==2016) | (df["model_year"]==2017) | (df["model_year"]==2023))].reset_index(drop=True)
+    # Drop relevant market years. No need to reset the index - generate_firm_ids merges, which does that
+    df = df.loc[~df["model_year"].isin([2016, 2017, 2023])]
     if year_to_drop:
-        df = df.loc[df["model_year"]!=year_to_drop].reset_index(drop=True)
+        df = df.loc[df["model_year"]!=year_to_drop]
 
     # Replace ZMS with a small number
     df.loc[df["veh_count"]==0, "veh_count"] = zms_replaced_with
 
     # Set the product IDs
-    df["product_ids"] = df.make + "_" + df.model + "_" + df.model_year.astype(str) + "_" + df.trim + "_" + df.fuel + "_" + df.range_elec.astype(str).str[0:3]
+    df["product_ids"] = df["make"].str.cat([df["model"], df["model_year"].astype(str), df["trim"], df["fuel"],
+                                            df["range_elec"].astype(str).str[0:3]], sep = "_")
     
     # Set the market IDs
     if mkt_def == "model_year":
         df["market_ids"] = df["model_year"]
     elif mkt_def == "county_model_year":
-        df["market_ids"] = df["county_name"] + "_" + df["model_year"].astype(str)
+        df["market_ids"] = df["county_name"].str.cat(df["model_year"].astype(str), sep = "_")
 
     # Generate firm IDs and fueltype dummies
     df = rlp_functions.generate_firm_ids(df, str_mapping)
@@ -190,13 +242,94 @@ def prepare_rlp_data(df, pop_density_path, makes_to_remove = None, mkt_def = "mo
     mkt_data = mkt_data.merge(pop_density[["market_ids", "pop_density"]], on =  "market_ids", how = 'left')
     assert(mkt_data["pop_density"].isnull().sum() == 0)
 
+    # Convert the OLS dummy columns to categoricals once, so get_dummies does not re-factorize the strings on
+    # every run_logit_model call. (PyBLP turns these back into object arrays, so this does not help the logit side)
+    for col in ['make', 'drivetype', 'bodytype', 'county_name']:
+        mkt_data[col] = mkt_data[col].astype("category")
+
     return mkt_data
 
+# Function to build the Logit specification string
+def logit_specification(j, data_source, params_master):
+    if data_source == "RLP" and rlp_market == "county_model_year":
+        params_logit = params_master[0:j] + [f'C({param})' for param in params_master[-3:]]+['C(county_name)']
+    else:
+        params_logit = params_master[0:j] + [f'C({param})' for param in params_master[-3:]]
+    params_str = ' + '.join(params_logit)
+    params_str = '0 + ' + params_str
+    return params_str
+
+# Function to fit a single specification on a single data source. Runs in a joblib worker process
+def fit_specification(j, data_source, mkt_data, params_str):
+    print(f"Running {data_source} data")
+    logit_formulation = pyblp.Formulation(params_str)
+
+    # Run the logit problem. Limit BLAS to one thread per worker - the workers already use all the cores
+    with threadpool_limits(limits = 1):
+        problem = pyblp.Problem(logit_formulation, mkt_data)
+        logit_results_price_updated = problem.solve()
+
+    # save results
+    df_logit = pd.DataFrame({'specification':j,
+                        'data_source':data_source,
+                        'param':logit_results_price_updated.beta_labels,
+                        'value':logit_results_price_updated.beta.flatten(),
+                        'se': logit_results_price_updated.beta_se.flatten()})
+
+    # The workers are reused across tasks, so free the problem and results before the next one
+    del problem, logit_results_price_updated
+    gc.collect()
+
+    return df_logit
+
+# Function to fit the OLS specifications on a single data source
+def fit_ols_specifications(mkt_data, data_source, params_master, specifications):
+    """
+    Regresses shares on the product characteristics for every specification. The specifications are nested,
+    so we build the design matrix and its Gram matrix once, for the widest specification, and solve the
+    normal equations on the relevant sub-block for each one. Standard errors are the non-robust ones,
+    as from sm.OLS(...).fit().
+    """
+    # Convert make, drivetype, and bodytype (and county) to dummies
+    params_widest = params_master[0:max(specifications)]
+    dummy_cols = ['make', 'drivetype', 'bodytype']
+    if data_source == "RLP" and rlp_market == "county_model_year":
+        dummy_cols = dummy_cols + ['county_name']
+    # Dummies are created as floats, so building the array takes one copy (to_numpy) rather than two (astype + to_numpy)
+    X = pd.get_dummies(mkt_data[params_widest + dummy_cols], columns = dummy_cols, drop_first = True, dtype = np.float64)
+    X = sm.add_constant(X)
+    Y = mkt_data['shares'].to_numpy(dtype = np.float64)
+    columns = X.columns
+    X = X.to_numpy(dtype = np.float64)
+
+    # Shared across all specifications
+    XtX = X.T @ X
+    Xty = X.T @ Y
+
+    output = {}
+    for j in specifications:
+        # Drop the characteristics that are not in this specification
+        ix = [k for k, col in enumerate(columns) if col not in params_widest[j:]]
+        XtX_j = XtX[np.ix_(ix, ix)]
+        XtX_j_inv = np.linalg.pinv(XtX_j) # pinv, as statsmodels does, in case of collinear columns
+        beta = XtX_j_inv @ Xty[ix]
+        resid = Y - X[:, ix] @ beta
+        sigma2 = (resid @ resid) / (len(Y) - np.linalg.matrix_rank(XtX_j))
+
+        output[j] = pd.DataFrame({'specification':j,
+                                  'data_source':data_source,
+                                  'param':columns[ix],
+                                  'value':beta,
+                                  # Clip at 0 - pinv can give a tiny negative entry for an all-zero regressor
+                                  'se': np.sqrt(sigma2 * np.clip(np.diag(XtX_j_inv), 0, None))})
+
+    return output
+
 # Function to run the logit model
-def run_logit_model(exp_df, rlp_df, subfolder, estimation_data_folder, myear = "all"):
-    # Set up the output dataframes
-    output_logit = pd.DataFrame()
-    output_ols = pd.DataFrame()
+def run_logit_model(exp_df, rlp_df, subfolder, estimation_data_folder, myear = "all", dump_csv = False):
+    # Set up the output lists - concatenated once at the end
+    output_logit = []
+    output_ols = []
 
     params_master = ['prices', 'dollar_per_mile', 'electric', 'phev', 'hybrid', 'diesel', 'log_hp_weight', 'wheelbase', 'doors', 'range_elec', 'make', 'drivetype', 'bodytype']
     specifications = [1, 2, 6, 7, 8, 9, 10]
@@ -204,70 +337,49 @@ def run_logit_model(exp_df, rlp_df, subfolder, estimation_data_folder, myear = "
 
     if isinstance(myear, int):
         rlp_df = rlp_df[rlp_df["model_year"]==myear]
-
-    # Save the market data
-    exp_df.to_csv(estimation_data_folder / f'exp_mkt_data_{date_time}.csv',index = False)
-    rlp_df.to_csv(estimation_data_folder / f'mkt_data_{rlp_market}_{date_time}_{myear}.csv',index = False)
+        # Otherwise get_dummies would generate all-zero columns for categories not in this year
+        rlp_df = rlp_df.assign(**{col: rlp_df[col].cat.remove_unused_categories() for col in rlp_df.select_dtypes("category")})
+
+    # Save the market data. The Experian data is the same for every myear, so we only write it once per run
+    # Pickles are much faster to write than CSVs - set dump_csv to also get a CSV copy
+    for df, filename in [(exp_df, f'exp_mkt_data_{date_time}'), (rlp_df, f'mkt_data_{rlp_market}_{date_time}_{myear}')]:
+        path = estimation_data_folder / f'{filename}.pkl'
+        if not path.exists():
+            df.to_pickle(path)
+        if dump_csv and not path.with_suffix('.csv').exists():
+            df.to_csv(path.with_suffix('.csv'), index = False)
+
+    # Each (specification, data source) pair is an independent problem, so we solve them in parallel
+    data_sources = {"Experian": exp_df, "RLP": rlp_df}
+    tasks = [(j, data_source, logit_specification(j, data_source, params_master)) for j in specifications for data_source in data_sources]
+    n_jobs = min(len(tasks), n_nodes if on_cluster else os.cpu_count())
+    results = Parallel(n_jobs = n_jobs, backend = "loky")(delayed(fit_specification)(j, data_source, data_sources[data_source], params_str) 
+                                                          for j, data_source, params_str in tasks)
+    results = iter(zip(tasks, results)) # Results come back in the same order as the tasks
+
+    # The OLS regressions are cheap, so we run them here
+    ols_results = {data_source: fit_ols_specifications(mkt_data, data_source, params_master, specifications)
+                   for data_source, mkt_data in data_sources.items()}
 
     for j in specifications:
-        output_specification_logit = pd.DataFrame()
-        output_specification_ols = pd.DataFrame()
-        for i, mkt_data in enumerate([exp_df, rlp_df]):
-            if i == 0:
-                data_source = "Experian"
-                print(f"Running {data_source} data")
-            elif i == 1:
-                data_source = "RLP"
-                print(f"Running {data_source} data")
-            
-
-            # Prepare the Logit specification
-            if data_source == "RLP" and rlp_market == "county_model_year":
-                params_logit = params_master[0:j] + [f'C({param})' for param in params_master[-3:]]+['C(county_name)']
-                params_ols = params_master[0:j] + [param for param in params_master[-3:]]+['county_name']
-            else:
-                params_logit = params_master[0:j] + [f'C({param})' for param in params_master[-3:]]
-                params_ols = params_master[0:j] + [param for param in params_master[-3:]]
-            params_str = ' + '.join(params_logit)
-            params_str = '0 + ' + params_str
-            logit_formulation = pyblp.Formulation(params_str)
+        output_specification_logit = []
+        output_specification_ols = []
+        for data_source in data_sources:
+            (_, _, params_str), df_logit = next(results)
+            df_ols = ols_results[data_source][j]
 
             # Log the datasource and specification
             logging.info(f"Data Source: {data_source}")
             logging.info(f"Specification: {params_str}")
 
-            # Run the logit problem
-            problem = pyblp.Problem(logit_formulation, mkt_data)
-            logit_results_price_updated = problem.solve()
-
-            # Prepare the OLS specification and Convert make, drivetype, and bodytype to dummies
-            X = mkt_data[params_ols]
-            if data_source == "RLP" and rlp_market == "county_model_year":
-                X = pd.get_dummies(X, columns = ['make', 'drivetype', 'bodytype', 'county_name'], drop_first = True)
-            else:
-                X = pd.get_dummies(X, columns = ['make', 'drivetype', 'bodytype'], drop_first = True)
-            Y = mkt_data['shares']
-            X = sm.add_constant(X)
-            ols_results = sm.OLS(Y.astype(float), X.astype(float)).fit()
-
-            # save results
-            df_logit = pd.DataFrame({'specification':j,
-                                'data_source':data_source,
-                                'param':logit_results_price_updated.beta_labels,
-                                'value':logit_results_price_updated.beta.flatten(),
-                                'se': logit_results_price_updated.beta_se.flatten()})
-            
-            df_ols = pd.DataFrame({'specification':j,
-                                'data_source':data_source,
-                                'param':ols_results.params.index,
-                                'value':ols_results.params.values,
-                                'se': ols_results.bse.values})
-            
-            output_specification_logit = pd.concat([output_specification_logit, df_logit], axis = 1)
-            output_specification_ols = pd.concat([output_specification_ols, df_ols], axis = 1)
-
-        output_logit = pd.concat([output_logit, output_specification_logit], axis = 0)
-        output_ols = pd.concat([output_ols, output_specification_ols], axis = 0)
+            output_specification_logit.append(df_logit)
+            output_specification_ols.append(df_ols)
+
+        output_logit.append(pd.concat(output_specification_logit, axis = 1))
+        output_ols.append(pd.concat(output_specification_ols, axis = 1))
+
+    output_logit = pd.concat(output_logit, axis = 0)
+    output_ols = pd.concat(output_ols, axis = 0)
 
     output_logit.to_csv(subfolder / f'comparison_outputs_logit_{rlp_market}_{date_time}_{myear}.csv',index = False)
     output_ols.to_csv(subfolder / f'comparison_outputs_ols_{rlp_market}_{date_time}_{myear}.csv',index = False)
@@ -294,4 +406,13 @@ agent_data = agent_data.loc[(agent_data["year"]>2017)&(agent_data["year"]!=2023)
 # Run the logit model
 run_logit_model(exp_mkt_data, rlp_mkt_data, output_subfolder, estimation_data_subfolder, myear = "all_years")
 
+# Optionally run the model for each model year. Each run already solves its specifications in parallel,
+# and reuses the saved Experian data from the run above
+if run_by_model_year:
+    for myear in sorted(rlp_mkt_data["model_year"].unique()):
+        try:
+            run_logit_model(exp_mkt_data, rlp_mkt_data, output_subfolder, estimation_data_subfolder, myear = int(myear))
+        except Exception:
+            logging.exception(f"Model year {myear} failed")
+
 
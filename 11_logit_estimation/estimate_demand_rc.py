@@ -104,28 +104,27 @@ logging.info("\n"+ description_template + "\n-----------------------------------
 ############################################################################################################
 # Helper functions
 def remove_makes(df, makes):
-    for make in makes:
-        df = df[df["make"]!=make]
-    return df
+    return df[~df["make"].isin(makes)]
 
 # We now prepare the RLP data, aiming to make it as similar as possible to the Experian data
 def prepare_rlp_data(df, pop_density_path, charging_data_path, makes_to_remove = None, mkt_def = "model_year", year_to_drop = None, zms_replaced_with = 0.001):
-    # Drop relevant market years
-    df = df.loc[~((df["model_year"]==2016) | (df["model_year"]==2017) | (df["model_year"]==2023))].reset_index(drop=True)
+    # Drop relevant market years. No need to reset the index - generate_firm_ids merges, which does that
+    df = df.loc[~df["model_year"].isin([2016, 2017, 2023])]
     if year_to_drop:
-        df = df.loc[df["model_year"]!=year_to_drop].reset_index(drop=True)
+        df = df.loc[df["model_year"]!=year_to_drop]
 
     # Replace ZMS with a small number
     df.loc[df["veh_count"]==0, "veh_count"] = zms_replaced_with
 
     # Set the product IDs
-    df["product_ids"] = df.make + "_" + df.model + "_" + df.model_year.astype(str) + "_" + df.trim + "_" + df.fuel + "_" + df.range_elec.astype(str).str[0:3]
+    df["product_ids"] = df["make"].str.cat([df["model"], df["model_year"].astype(str), df["trim"], df["fuel"],
+                                            df["range_elec"].astype(str).str[0:3]], sep = "_")
     
     # Set the market IDs
     if mkt_def == "model_year":
         df["market_ids"] = df["model_year"]
     elif mkt_def == "county_model_year":
-        df["market_ids"] = df["county_name"] + "_" + df["model_year"].astype(str)
+        df["market_ids"] = df["county_name"].str.cat(df["model_year"].astype(str), sep = "_")
 
     # Generate firm IDs and fueltype dummies
     df = rlp_functions.generate_firm_ids(df, str_mapping)
@@ -19,15 +19,6 @@ phev_elec_share = 0.563
 import pathlib
 import pandas as pd
 import numpy as np
-from itertools import combinations, product
-import os
-from tqdm import tqdm
-import requests
-from datetime import datetime
-import geopandas as gpd
-import matplotlib.pyplot as plt
-import warnings
-import platform
 
 # Warnings and display
 pd.set_option('display.max_rows', 500)
@@ -42,7 +33,10 @@ rlp_data_file = "ct_decoded_full_attributes.csv"
 
 # Import the final RLP data
 print(f"Importing the RLP data to be finalized, located at {str_rlp_data / rlp_data_file}")
-df_rlp = pd.read_csv(str_rlp_data / rlp_data_file)
+# Low-cardinality text columns are read as categoricals, which avoids storing one Python string per row
+rlp_dtypes = {"make": "category", "model": "category", "trim": "category", "county_name": "category",
+              "fuel": "category", "fuel1": "category", "fuel2": "category", "report_year_month": "int32"}
+df_rlp = pd.read_csv(str_rlp_data / rlp_data_file, dtype = rlp_dtypes)
 len_rlp = len(df_rlp)
 
 ####################################################################################################
@@ -52,15 +46,16 @@ str_gas_processed = str_energy / "monthly_gas_prices_processed.csv"
 str_diesel_processed = str_energy / "monthly_diesel_prices_processed.csv"
 str_electricity_processed = str_energy / "yearly_electricity_prices_processed.csv"
 
-# Read in data
-df_gas = pd.read_csv(str_gas_processed)
-df_diesel = pd.read_csv(str_diesel_processed)
-df_electricity = pd.read_csv(str_electricity_processed)
+# Read in data - only the columns used in the merges below
+df_gas = pd.read_csv(str_gas_processed, usecols = ["Year", "Month", "Gas_Price_21"])
+df_diesel = pd.read_csv(str_diesel_processed, usecols = ["Year", "Month", "Diesel_Price_21"])
+df_electricity = pd.read_csv(str_electricity_processed, usecols = ["Year", "Electricity_Price_21"])
 
 ####################################################################################################
 # Clean the RLP data
-df_rlp.loc[:, "report_year"] = df_rlp.loc[:, "report_year_month"].astype(str).str[:4].astype(int)
-df_rlp.loc[:, "report_month"] = df_rlp.loc[:, "report_year_month"].astype(str).str[4:].astype(int)
+# report_year_month is an integer of the form YYYYMM
+df_rlp["report_year"] = df_rlp["report_year_month"] // 100
+df_rlp["report_month"] = df_rlp["report_year_month"] % 100
 df_rlp = df_rlp.drop(columns=["report_year_month"])
 
 # Check how many NAs there are in the combined col
@@ -80,24 +75,20 @@ df_rlp["log_hp_wt"] = np.log(df_rlp["max_hp"] / df_rlp["curb_weight"])
 
 ####################################################################################################
 # Merge the RLP data with the energy data
-df_rlp = df_rlp.merge(df_gas[["year", "month", "gas_price_21"]], left_on = ["report_year", "report_month"],
-                      right_on = ["year", "month"], how = "left")
+# Combine the (small) energy tables first, so that the large RLP frame is only merged once
+df_prices = df_gas.merge(df_diesel, on = ["year", "month"], how = "outer", validate = "1:1")
+df_prices = df_prices.merge(df_electricity, on = "year", how = "left", validate = "m:1")
 
-df_rlp = df_rlp.merge(df_diesel[["year", "month", "diesel_price_21"]], left_on = ["report_year", "report_month"],
-                      right_on = ["year", "month"], how = "left")
-
-df_rlp = df_rlp.merge(df_electricity[["year", "electricity_price_21"]], left_on = ["report_year"],
-                        right_on = ["year"], how = "left")
+df_rlp = df_rlp.merge(df_prices, left_on = ["report_year", "report_month"], right_on = ["year", "month"],
+                      how = "left", validate = "m:1")
+df_rlp = df_rlp.drop(columns = ["year", "month"])
 
 assert(len(df_rlp) == len_rlp), "Length mismatch"
 
-# Confirm the match worked and drop the extra columns
-assert(df_rlp["year_x"].equals(df_rlp["year_y"])), "Year mismatch"
-assert(df_rlp["month_x"].equals(df_rlp["month_y"])), "Month mismatch"
-assert(df_rlp["year_x"].equals(df_rlp["year"])), "Year mismatch"
-assert(df_rlp["year_x"].equals(df_rlp["report_year"])), "Year mismatch"
-assert(df_rlp["month_x"].equals(df_rlp["report_month"])), "Month mismatch"
-df_rlp = df_rlp.drop(columns = ["year_x", "month_x", "year_y", "month_y", "year"])
+# Confirm the match worked
+assert(df_rlp["gas_price_21"].notna().all()), "Gas price match failed"
+assert(df_rlp["diesel_price_21"].notna().all()), "Diesel price match failed"
+assert(df_rlp["electricity_price_21"].notna().all()), "Electricity price match failed"
 
 ####################################################################################################
 # Convert variable values to lower case
@@ -105,27 +96,9 @@ df_rlp["fuel"] = df_rlp["fuel"].str.lower()
 df_rlp["fuel1"] = df_rlp["fuel1"].str.lower()
 df_rlp["fuel2"] = df_rlp["fuel2"].str.lower()
 
-# Calculate the dollar per mile for gasoline and hybrid
-mask = ((df_rlp["fuel"] == "gasoline")|(df_rlp["fuel"] == "hybrid"))
-df_rlp.loc[mask, "dollar_per_mile"] = df_rlp.loc[mask, "gas_price_21"] / df_rlp.loc[mask, "combined"]
-
-# Calculate the dollar per mile for diesel
-mask = (df_rlp["fuel"] == "diesel")
-df_rlp.loc[mask, "dollar_per_mile"] = df_rlp.loc[mask, "diesel_price_21"] / df_rlp.loc[mask, "combined"]
-
-# Calculate the dollar per for flex fuel, using gas price
-mask = (df_rlp["fuel"] == "flex fuel")
-df_rlp.loc[mask, "dollar_per_mile"] = df_rlp.loc[mask, "gas_price_21"] / df_rlp.loc[mask, "combined"]
-
-# Calculate the dollar per mile for electric EPA fueleconomy.gov says 33.7 kWh per gallon
-mask = (df_rlp["fuel"] == "electric")
-df_rlp.loc[mask, "dollar_per_mile"] = (df_rlp.loc[mask, "electricity_price_21"] / 100) * (33.7 / df_rlp.loc[mask, "combined"])
-
-# Calculate the dollar per mile for PHEV 
-mask = (df_rlp["fuel"] == "phev")
-
-# There are some erroneous fuels to address 
+# There are some erroneous PHEV fuels to address
 # Mark the entries to drop and count how many 
+mask = (df_rlp["fuel"] == "phev")
 df_rlp.loc[:, "phev_erroneous_fuels"] = 0
 df_rlp.loc[mask & (df_rlp["fuel1"].isna()) & (df_rlp["fuel2"].isna()), "phev_erroneous_fuels"] = 1
 phev_erroneous = df_rlp.loc[mask, "phev_erroneous_fuels"].sum()
@@ -135,12 +108,34 @@ print(f"Dropping {phev_erroneous} PHEV vehicles with missing fuel types")
 len_df = len(df_rlp)
 df_rlp = df_rlp.loc[(df_rlp["phev_erroneous_fuels"] == 0)]
 assert(len(df_rlp) == len_df - phev_erroneous)
+mask = (df_rlp["fuel"] == "phev")
 assert(df_rlp.loc[mask, "fuel1"].unique().tolist() == ["gasoline"]), "PHEV fuel 1 is not gasoline" # Confirm the variable ordering
 assert(df_rlp.loc[mask, "fuel2"].unique().tolist() == ["electricity"]), "PHEV fuel 2 is not electric"
-df_rlp.loc[mask, "dollar_per_mile_gas"] = df_rlp.loc[mask, "gas_price_21"] / df_rlp.loc[mask, "combined_mpg1"]
-df_rlp.loc[mask, "dollar_per_mile_elec"] = (df_rlp.loc[mask, "electricity_price_21"] / 100) * (33.7 / df_rlp.loc[mask, "combined_mpg2"])
-df_rlp.loc[mask, "dollar_per_mile"] = (df_rlp.loc[mask, "dollar_per_mile_gas"] * (1 - phev_elec_share)) + (df_rlp.loc[mask, "dollar_per_mile_elec"] * phev_elec_share)
-df_rlp = df_rlp.drop(columns = ["dollar_per_mile_gas", "dollar_per_mile_elec"])
+
+# Calculate the dollar per mile for every fuel type in a single pass
+# - Gasoline, hybrid, and flex fuel use the gas price
+# - Electric: EPA fueleconomy.gov says 33.7 kWh per gallon
+# - PHEV: weighted average of the gas and electric dollar per mile
+fuel = df_rlp["fuel"].to_numpy()
+gas = df_rlp["gas_price_21"].to_numpy()
+diesel = df_rlp["diesel_price_21"].to_numpy()
+elec = df_rlp["electricity_price_21"].to_numpy() / 100
+combined = df_rlp["combined"].to_numpy()
+
+with np.errstate(divide = "ignore", invalid = "ignore"): # Each branch is evaluated for all rows
+    dollar_per_mile = np.select([np.isin(fuel, ["gasoline", "hybrid", "flex fuel"]),
+                                 fuel == "diesel",
+                                 fuel == "electric"],
+                                [gas / combined,
+                                 diesel / combined,
+                                 elec * (33.7 / combined)],
+                                default = np.nan)
+
+# PHEVs are only a small share of rows, so only calculate their mix on those rows
+phev = (fuel == "phev")
+dollar_per_mile[phev] = ((gas[phev] / df_rlp["combined_mpg1"].to_numpy()[phev]) * (1 - phev_elec_share)
+                         + (elec[phev] * (33.7 / df_rlp["combined_mpg2"].to_numpy()[phev])) * phev_elec_share)
+df_rlp["dollar_per_mile"] = dollar_per_mile
 
 # Drop any vehicles not in the categories above
 dropped_dollar_per_mile = df_rlp["dollar_per_mile"].isna().sum()
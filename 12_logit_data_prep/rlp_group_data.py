@@ -247,9 +247,9 @@ def aggregate_to_market(df, most_common_trim_features):
         most_common_trim_features_orig = most_common_trim_features.copy()
         most_common_trim_features = most_common_trim_features.drop(columns = ["veh_count"])
         
-        # Aggregate and check
+        # Aggregate and check. The model year totals are summed from the (much smaller) county level output
         output_counties = df[["make", "model", "model_year", "trim", "fuel", "range_elec", "county_name", "veh_count"]].groupby(["make", "model", "model_year", "trim", "fuel", "range_elec", "county_name"]).sum().reset_index()
-        output_myear = df[["make", "model", "model_year", "trim", "fuel", "range_elec", "veh_count"]].groupby(["make", "model", "model_year", "trim", "fuel", "range_elec"]).sum()
+        output_myear = output_counties[["make", "model", "model_year", "trim", "fuel", "range_elec", "veh_count"]].groupby(["make", "model", "model_year", "trim", "fuel", "range_elec"]).sum()
         assert(output_counties["veh_count"].sum() == df["veh_count"].sum())
         assert(output_myear["veh_count"].sum() == df["veh_count"].sum())
     